@@ -1,15 +1,48 @@
 import os
+import copy
 import logging
 import json
 import time
+import random
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Callable, Any
 import openai
+import tiktoken
 from src.utils.text_processor import TextProcessor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Process-wide API clients keyed by (api_key, base_url), shared across
+# TranscriptTransformer instances so their HTTP connection pools are reused
+_CLIENT_CACHE: Dict[tuple, openai.OpenAI] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+def _get_client(api_key: Optional[str], base_url: Optional[str] = None) -> openai.OpenAI:
+    """Return a cached OpenAI-compatible client for the given credentials and endpoint"""
+    key = (api_key, base_url)
+    with _CLIENT_CACHE_LOCK:
+        client = _CLIENT_CACHE.get(key)
+        if client is None:
+            if base_url:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url)
+            else:
+                client = openai.OpenAI(api_key=api_key)
+            _CLIENT_CACHE[key] = client
+        return client
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model_name: str) -> "tiktoken.Encoding":
+    """Return the (cached) tiktoken encoding for a model, defaulting to cl100k_base"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
 class WordCountError(Exception):
     """Raised when word count requirements are not met"""
     pass
@@ -20,38 +53,176 @@ class TranscriptTransformer:
     MAX_RETRIES = 3  # Initial retries for content generation
     EXTENDED_RETRIES = 3  # Additional retries with longer waits
     EXTENDED_RETRY_DELAYS = [5, 10, 15]  # Wait times in seconds for extended retries
+    RETRY_JITTER = 3.0  # Maximum random seconds added to each extended retry wait
     CHUNK_SIZE = 6000  # Target words per chunk
     LARGE_DEVIATION_THRESHOLD = 0.20  # 20% maximum deviation
     MAX_TOKENS = 64000  # Nuevo límite absoluto basado en 64k tokens de salida
+    MAX_CONCURRENT_TOPICS = 4  # Upper bound on main topics generated in parallel
+    # Lower concurrency for models with tight request-per-minute quotas
+    MODEL_MAX_CONCURRENT_TOPICS = {
+        "gemini-2.0-flash-thinking-exp-01-21": 1
+    }
+    # Context windows (prompt + completion tokens) for models that need max_tokens clamped
+    MODEL_CONTEXT_WINDOWS = {
+        "gpt-3.5-turbo": 16385
+    }
+    # Completion token caps for models whose output limit is below MAX_TOKENS
+    MODEL_MAX_OUTPUT_TOKENS = {
+        "gpt-3.5-turbo": 4096
+    }
+    MESSAGE_TOKEN_OVERHEAD = 16  # Chat formatting tokens added per request
+    NARRATIVE_WORDS = 200  # Trailing words of generated content carried into the next prompt
+    
+    # Last resort structure used when no outline can be obtained from the model
+    FALLBACK_STRUCTURE = {
+        "title": "Lecture on Transcript Topic",
+        "learning_objectives": ["Understand key concepts", "Apply knowledge", "Evaluate outcomes"],
+        "topics": [
+            {
+                "title": "Main Topic 1",
+                "key_concepts": ["Concept 1", "Concept 2"],
+                "subtopics": ["Subtopic 1", "Subtopic 2"],
+                "duration_minutes": 0,
+                "objective_links": [1, 2]
+            },
+            {
+                "title": "Main Topic 2",
+                "key_concepts": ["Concept 3", "Concept 4"],
+                "subtopics": ["Subtopic 3", "Subtopic 4"],
+                "duration_minutes": 0,
+                "objective_links": [2, 3]
+            }
+        ],
+        "practical_applications": ["Application 1", "Application 2"],
+        "key_terms": ["Term 1", "Term 2", "Term 3"]
+    }
+    
+    # Keys a parsed outline must have to be used as the lecture structure
+    REQUIRED_STRUCTURE_KEYS = ('title', 'learning_objectives', 'topics', 'key_terms')
+    MAX_JSON_DEPTH = 32  # Deepest nesting accepted when extracting the outline JSON
+    
+    # Section prompt fragments, filled in with str.format_map by _generate_section
+    SECTION_HEADER_TEMPLATE = """
+        You are creating a {section_type} section for a {time_marker} teaching lecture on "{title}".
+        {user_instructions}
+        Target word count: {target_words} words (very important)
+        
+        Learning objectives:
+        {learning_objectives}
+        
+        Key terms:
+        {key_terms}
+        
+        Original source:
+        {source_excerpt}...
+        """
+    
+    SECTION_TEMPLATES = {
+        'introduction': """
+            - Start with an engaging hook
+            - Present clear learning objectives
+            - Preview main topics
+            - Set expectations for the lecture
+            """,
+        'main': """
+            Discuss one main topic in depth.
+            
+            Topic: {topic_title}
+            Key concepts: {topic_key_concepts}
+            Subtopics: {topic_subtopics}
+            
+            - Start with appropriate time marker
+            - Explain key concepts clearly
+            - Include real-world examples
+            - Connect to learning objectives
+            - Use appropriate time markers within the section
+            """,
+        'practical': """
+            Create a practical applications section with:
+            
+            - Start with appropriate time marker
+            - 2-3 practical examples or case studies
+            - Clear connections to the main topics
+            - Interactive elements (questions, exercises)
+            
+            Practical applications to cover:
+            {practical_applications}
+            """,
+        'summary': """
+            Create a concise summary:
+            
+            - Start with appropriate time marker
+            - Reinforce key learning points
+            - Brief recap of main topics
+            - Call to action or follow-up suggestions
+            """
+    }
+    
+    SECTION_CONTEXT_TEMPLATE = """
+            
+            Previously covered topics:
+            {covered_topics}
+            
+            Pending topics:
+            {pending_topics}
+            
+            Recent narrative context:
+            {current_narrative}
+            """
+    
+    FIRST_SECTION_TEMPLATE = """
+            
+            This is the FIRST section of the lecture. Make it engaging and set the tone.
+            """
+    
+    LAST_SECTION_TEMPLATE = """
+            
+            This is the FINAL section of the lecture. Ensure proper closure and reinforcement.
+            """
+    
+    TIME_MARKERS_TEMPLATE = """
+            
+            IMPORTANT: Include appropriate time markers [MM:SS] throughout the section.
+            """
     
-    def __init__(self, use_gemini: bool = True, use_thinking_model: bool = False):
-        """Initialize the transformer with selected LLM client"""
+    def __init__(self,
+                 use_gemini: bool = True,
+                 use_thinking_model: bool = False,
+                 prefer_local_fallback: bool = False):
+        """
+        Initialize the transformer with selected LLM client
+        
+        Args:
+            use_gemini: Whether to use Gemini API instead of OpenAI
+            use_thinking_model: Requires use_gemini=True
+            prefer_local_fallback: Derive the fallback structure locally instead
+                of making a second API call when structure generation fails
+        """
         self.text_processor = TextProcessor()
         self.use_gemini = use_gemini
         self.use_thinking_model = use_thinking_model
+        self.prefer_local_fallback = prefer_local_fallback
         
         if use_thinking_model:
             if not use_gemini:
                 raise ValueError("Thinking model requires use_gemini=True")
                 
             logger.info("Initializing with Gemini Flash Thinking API")
-            self.openai_client = openai.OpenAI(
-                api_key=os.getenv('GEMINI_API_KEY'),
-                base_url="https://generativelanguage.googleapis.com/v1alpha"
+            self.openai_client = _get_client(
+                os.getenv('GEMINI_API_KEY'),
+                "https://generativelanguage.googleapis.com/v1alpha"
             )
             self.model_name = "gemini-2.0-flash-thinking-exp-01-21"
         elif use_gemini:
             logger.info("Initializing with Gemini API")
-            self.openai_client = openai.OpenAI(
-                api_key=os.getenv('GEMINI_API_KEY'),
-                base_url="https://generativelanguage.googleapis.com/v1beta"
+            self.openai_client = _get_client(
+                os.getenv('GEMINI_API_KEY'),
+                "https://generativelanguage.googleapis.com/v1beta"
             )
             self.model_name = "gemini-2.0-flash-exp"
         else:
             logger.info("Initializing with OpenAI API")
-            self.openai_client = openai.OpenAI(
-                api_key=os.getenv('OPENAI_API_KEY')
-            )
+            self.openai_client = _get_client(os.getenv('OPENAI_API_KEY'))
             self.model_name = "gpt-3.5-turbo"
         
         # Target word counts
@@ -83,8 +254,10 @@ class TranscriptTransformer:
                 
                 # Extended retries with longer waits
                 for i in range(self.EXTENDED_RETRIES):
-                    wait_time = self.EXTENDED_RETRY_DELAYS[i]
-                    logger.info(f"Extended retry {i+1}/{self.EXTENDED_RETRIES}: Waiting {wait_time} seconds before retry")
+                    # Jitter spreads out retries from concurrent topic requests
+                    # that hit the quota at the same moment
+                    wait_time = self.EXTENDED_RETRY_DELAYS[i] + random.uniform(0, self.RETRY_JITTER)
+                    logger.info(f"Extended retry {i+1}/{self.EXTENDED_RETRIES}: Waiting {wait_time:.1f} seconds before retry")
                     time.sleep(wait_time)
                     
                     try:
@@ -152,8 +325,9 @@ class TranscriptTransformer:
             target_duration=target_duration,
             initial_prompt=initial_prompt
         )
+        self._prepare_structure(structure_data)
         logger.info("Detailed lecture structure generated")
-        logger.info(f"Topics identified: {[t['title'] for t in structure_data['topics']]}")
+        logger.info(f"Topics identified: {structure_data['_topic_titles_str']}")
         
         # Calculate section word counts
         section_words = {
@@ -183,9 +357,9 @@ class TranscriptTransformer:
             context = {
                 'current_section': 'introduction',
                 'covered_topics': [],
-                'pending_topics': [t['title'] for t in structure_data['topics']],
+                'pending_topics': list(structure_data['_topic_titles']),
                 'key_terms': set(),
-                'current_narrative': intro[-1000:],  # Last 1000 words for context
+                'current_narrative': deque(intro.split()[-self.NARRATIVE_WORDS:], maxlen=self.NARRATIVE_WORDS),
                 'learning_objectives': structure_data['learning_objectives']
             }
             
@@ -203,7 +377,7 @@ class TranscriptTransformer:
             
             # Update context after main content
             context['current_section'] = 'main'
-            context['current_narrative'] = main_content[-1000:]
+            context['current_narrative'].extend(main_content.split()[-self.NARRATIVE_WORDS:])
             
             # Practical applications tied to main topics
             practical = self._generate_section(
@@ -220,7 +394,7 @@ class TranscriptTransformer:
             
             # Update context for summary
             context['current_section'] = 'practical'
-            context['current_narrative'] = practical[-500:]
+            context['current_narrative'].extend(practical.split()[-self.NARRATIVE_WORDS:])
             
             # Summary with topic reinforcement
             summary = self._generate_section(
@@ -238,7 +412,9 @@ class TranscriptTransformer:
             
             # Combine all sections
             full_content = f"{intro}\n\n{main_content}\n\n{practical}\n\n{summary}"
-            total_words = self.text_processor.count_words(full_content)
+            # Sections are joined on blank lines, so no word spans a boundary
+            # and the per-section counts add up to the full count
+            total_words = intro_words + main_words + practical_words + summary_words
             logger.info(f"Total content generated: {total_words} words")
             
             # Log warnings/errors but don't raise exceptions
@@ -334,27 +510,14 @@ class TranscriptTransformer:
             content = response.choices[0].message.content.strip()
             logger.debug(f"Raw structure response: {content}")
             
-            try:
-                structure_data = json.loads(content)
+            structure_data = self._extract_json(content)
+            if structure_data is not None:
                 logger.info("Structure data parsed successfully")
                 return structure_data
-            except json.JSONDecodeError as e:
-                logger.warning(f"Failed to parse JSON directly: {str(e)}")
-                
-                # Try to extract JSON if it's wrapped in other text
-                import re
-                json_match = re.search(r'({[\s\S]*})', content)
-                if json_match:
-                    try:
-                        structure_data = json.loads(json_match.group(1))
-                        logger.info("Structure data extracted and parsed successfully")
-                        return structure_data
-                    except json.JSONDecodeError:
-                        logger.warning("Failed to parse extracted JSON")
                 
-                # If both attempts fail, use fallback structure
-                logger.warning("Using fallback structure")
-                return self._generate_fallback_structure(text, target_duration)
+            # If no JSON object could be parsed, use fallback structure
+            logger.warning("Failed to parse JSON structure, using fallback structure")
+            return self._generate_fallback_structure(text, target_duration)
                 
         except Exception as e:
             logger.error(f"Error generating structure: {str(e)}")
@@ -363,6 +526,9 @@ class TranscriptTransformer:
             
     def _generate_fallback_structure(self, text: str, target_duration: int) -> Dict:
         """Generate a simplified fallback structure in case of parsing failures"""
+        if self.prefer_local_fallback:
+            return self._local_fallback_structure(text, target_duration)
+            
         logger.info("Generating fallback structure")
         
         params = {
@@ -396,57 +562,132 @@ class TranscriptTransformer:
             response = self._api_call_with_enhanced_retries(api_call)
             content = response.choices[0].message.content.strip()
             
-            try:
-                return json.loads(content)
-            except json.JSONDecodeError:
-                # Last resort fallback if everything fails
-                return {
-                    "title": "Lecture on Transcript Topic",
-                    "learning_objectives": ["Understand key concepts", "Apply knowledge", "Evaluate outcomes"],
-                    "topics": [
-                        {
-                            "title": "Main Topic 1",
-                            "key_concepts": ["Concept 1", "Concept 2"],
-                            "subtopics": ["Subtopic 1", "Subtopic 2"],
-                            "duration_minutes": target_duration // 2,
-                            "objective_links": [1, 2]
-                        },
-                        {
-                            "title": "Main Topic 2",
-                            "key_concepts": ["Concept 3", "Concept 4"],
-                            "subtopics": ["Subtopic 3", "Subtopic 4"],
-                            "duration_minutes": target_duration // 2,
-                            "objective_links": [2, 3]
-                        }
-                    ],
-                    "practical_applications": ["Application 1", "Application 2"],
-                    "key_terms": ["Term 1", "Term 2", "Term 3"]
-                }
+            structure_data = self._extract_json(content)
+            if structure_data is not None:
+                return structure_data
+            # Last resort fallback if everything fails
+            return self._local_fallback_structure(text, target_duration)
         except Exception as e:
             logger.error(f"Error generating fallback structure: {str(e)}")
-            # Hardcoded last resort fallback
-            return {
-                "title": "Lecture on Transcript Topic",
-                "learning_objectives": ["Understand key concepts", "Apply knowledge", "Evaluate outcomes"],
-                "topics": [
-                    {
-                        "title": "Main Topic 1",
-                        "key_concepts": ["Concept 1", "Concept 2"],
-                        "subtopics": ["Subtopic 1", "Subtopic 2"],
-                        "duration_minutes": target_duration // 2,
-                        "objective_links": [1, 2]
-                    },
-                    {
-                        "title": "Main Topic 2",
-                        "key_concepts": ["Concept 3", "Concept 4"],
-                        "subtopics": ["Subtopic 3", "Subtopic 4"],
-                        "duration_minutes": target_duration // 2,
-                        "objective_links": [2, 3]
-                    }
-                ],
-                "practical_applications": ["Application 1", "Application 2"],
-                "key_terms": ["Term 1", "Term 2", "Term 3"]
-            }
+            # Last resort fallback without further API calls
+            return self._local_fallback_structure(text, target_duration)
+            
+    def _local_fallback_structure(self, text: str, target_duration: int) -> Dict:
+        """
+        Derive a minimal lecture structure from the transcript without any API call
+        
+        The most frequent content words become the topics and key terms.
+        Falls back to the hardcoded structure when the text is too short.
+        
+        Args:
+            text: Cleaned transcript text
+            target_duration: Target lecture duration in minutes
+            
+        Returns:
+            Dict: Lecture structure in the same format as the LLM output
+        """
+        logger.info("Generating local fallback structure")
+        
+        structure_data = self._default_structure(target_duration)
+        keywords = self.text_processor.extract_keywords(text, top_n=10)
+        if len(keywords) < 3:
+            return structure_data
+            
+        topic_terms = keywords[:3]
+        related_terms = keywords[3:]
+        
+        structure_data['title'] = f"Lecture on {topic_terms[0].capitalize()}"
+        structure_data['learning_objectives'] = [f"Understand {term}" for term in topic_terms]
+        structure_data['topics'] = []
+        for i, term in enumerate(topic_terms):
+            # Distribute the remaining keywords across topics as supporting concepts
+            concepts = related_terms[i::len(topic_terms)]
+            structure_data['topics'].append({
+                "title": term.capitalize(),
+                "key_concepts": [term] + concepts,
+                "subtopics": concepts,
+                "duration_minutes": max(1, target_duration // len(topic_terms)),
+                "objective_links": [i + 1]
+            })
+        structure_data['key_terms'] = keywords
+        return structure_data
+        
+    def _prepare_structure(self, structure_data: Dict) -> None:
+        """
+        Attach derived strings reused by every section prompt
+        
+        The joins are computed once per lecture instead of once per
+        section and per topic. Derived keys are prefixed with an underscore.
+        
+        Args:
+            structure_data: Lecture structure, updated in place
+        """
+        # Topics returned without key concepts get an empty list
+        for topic in structure_data['topics']:
+            topic.setdefault('key_concepts', [])
+            
+        structure_data['_objectives_str'] = ', '.join(structure_data['learning_objectives'])
+        structure_data['_key_terms_str'] = ', '.join(structure_data['key_terms'])
+        structure_data['_topic_titles'] = [t['title'] for t in structure_data['topics']]
+        structure_data['_topic_titles_str'] = ', '.join(structure_data['_topic_titles'])
+        
+    def _default_structure(self, target_duration: int) -> Dict:
+        """Build the hardcoded last resort structure for the given duration"""
+        structure_data = copy.deepcopy(self.FALLBACK_STRUCTURE)
+        for topic in structure_data['topics']:
+            topic['duration_minutes'] = target_duration // 2
+        return structure_data
+        
+    def _extract_json(self, content: str) -> Optional[Dict]:
+        """
+        Extract the lecture outline object embedded in a model response
+        
+        Walks the response once, tracking bracket depth and string/escape
+        state, and decodes each balanced top-level {...} candidate exactly
+        once, so responses wrapped in prose or code fences are handled in a
+        single linear pass. Only objects carrying every key in
+        REQUIRED_STRUCTURE_KEYS are accepted, so a truncated outline (which
+        never balances) is rejected rather than mistaken for a nested topic.
+        
+        Args:
+            content: Raw model response
+            
+        Returns:
+            Optional[Dict]: Parsed outline, or None if no valid outline is found
+        """
+        depth = 0
+        start = 0
+        in_string = escaped = False
+        
+        for i, char in enumerate(content):
+            if depth == 0:
+                # Outside any candidate only an opening brace matters
+                if char == '{':
+                    start, depth = i, 1
+                continue
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+                if depth > self.MAX_JSON_DEPTH:
+                    return None
+            elif char in '}]':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        obj = json.loads(content[start:i + 1])
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(obj, dict) and all(key in obj for key in self.REQUIRED_STRUCTURE_KEYS):
+                        return obj
+        return None
         
     def _generate_section(self,
                          section_type: str,
@@ -475,109 +716,55 @@ class TranscriptTransformer:
         
         user_instructions = f"\nAdditional user instructions:\n{initial_prompt}\n" if initial_prompt else ""
         
-        # Base prompt with context-specific formatting
-        prompt = f"""
-        You are creating a {section_type} section for a {time_marker} teaching lecture on "{structure_data['title']}".
-        {user_instructions}
-        Target word count: {target_words} words (very important)
-        
-        Learning objectives:
-        {', '.join(structure_data['learning_objectives'])}
-        
-        Key terms:
-        {', '.join(structure_data['key_terms'])}
-        
-        Original source:
-        {original_text[:500]}...
-        """
-        
-        # Section-specific instructions
-        if section_type == 'introduction':
-            prompt += """
-            - Start with an engaging hook
-            - Present clear learning objectives
-            - Preview main topics
-            - Set expectations for the lecture
-            """
-        elif section_type == 'main':
-            prompt += f"""
-            Discuss one main topic in depth.
-            
-            Topic: {context['current_topic']['title']}
-            Key concepts: {', '.join(context['current_topic']['key_concepts'])}
-            Subtopics: {', '.join(context['current_topic']['subtopics'])}
-            
-            - Start with appropriate time marker
-            - Explain key concepts clearly
-            - Include real-world examples
-            - Connect to learning objectives
-            - Use appropriate time markers within the section
-            """
-        elif section_type == 'practical':
-            prompt += f"""
-            Create a practical applications section with:
-            
-            - Start with appropriate time marker
-            - 2-3 practical examples or case studies
-            - Clear connections to the main topics
-            - Interactive elements (questions, exercises)
-            
-            Practical applications to cover:
-            {', '.join(structure_data['practical_applications'])}
-            """
-        elif section_type == 'summary':
-            prompt += """
-            Create a concise summary:
-            
-            - Start with appropriate time marker
-            - Reinforce key learning points
-            - Brief recap of main topics
-            - Call to action or follow-up suggestions
-            """
-        
-        # Context-specific content
+        ns = {
+            'title': structure_data['title'],
+            'user_instructions': user_instructions,
+            'learning_objectives': structure_data['_objectives_str'],
+            'key_terms': structure_data['_key_terms_str'],
+            'source_excerpt': original_text[:500],
+            'section_type': section_type,
+            'time_marker': time_marker,
+            'target_words': target_words
+        }
+        if section_type == 'practical':
+            ns['practical_applications'] = ', '.join(structure_data['practical_applications'])
         if context:
-            prompt += f"""
-            
-            Previously covered topics:
-            {', '.join(context['covered_topics'])}
-            
-            Pending topics:
-            {', '.join(context['pending_topics'])}
-            
-            Recent narrative context:
-            {context['current_narrative']}
-            """
-        
-        # First/last section specific instructions
+            ns['covered_topics'] = ', '.join(context['covered_topics'])
+            ns['pending_topics'] = ', '.join(context['pending_topics'])
+            ns['current_narrative'] = ' '.join(context['current_narrative'])
+        
+        # Main topic sections are named main_topic_<title> and share the 'main' template
+        template_key = 'main' if section_type.startswith('main_topic_') else section_type
+        if template_key == 'main':
+            topic = (context or {}).get('current_topic', {})
+            ns['topic_title'] = topic.get('title', '')
+            ns['topic_key_concepts'] = ', '.join(str(concept) for concept in topic.get('key_concepts', []))
+            ns['topic_subtopics'] = ', '.join(str(subtopic) for subtopic in topic.get('subtopics', []))
+        
+        # Assemble the prompt from the precompiled fragments
+        fragments = [self.SECTION_HEADER_TEMPLATE, self.SECTION_TEMPLATES.get(template_key, "")]
+        if context:
+            fragments.append(self.SECTION_CONTEXT_TEMPLATE)
         if is_first:
-            prompt += """
-            
-            This is the FIRST section of the lecture. Make it engaging and set the tone.
-            """
+            fragments.append(self.FIRST_SECTION_TEMPLATE)
         elif is_last:
-            prompt += """
-            
-            This is the FINAL section of the lecture. Ensure proper closure and reinforcement.
-            """
-            
-        # Add section-specific time markers for formatted output
+            fragments.append(self.LAST_SECTION_TEMPLATE)
         if section_type != 'introduction':
-            prompt += """
-            
-            IMPORTANT: Include appropriate time markers [MM:SS] throughout the section.
-            """
+            fragments.append(self.TIME_MARKERS_TEMPLATE)
+        prompt = "".join(fragment.format_map(ns) for fragment in fragments)
             
         try:
+            system_prompt = "You are an expert educator creating a teaching script."
+            
             # Prepare API call parameters
             params = {
                 "model": self.model_name,
                 "messages": [
-                    {"role": "system", "content": "You are an expert educator creating a teaching script."},
+                    {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ],
                 "temperature": 0.7,
-                "max_tokens": self._calculate_max_tokens(section_type, target_words)
+                "max_tokens": self._calculate_max_tokens(section_type, target_words, system_prompt + prompt)
             }
             
             # Add thinking config if using experimental model
@@ -588,12 +775,12 @@ class TranscriptTransformer:
                     }
                 }
 
-            # Use the enhanced retry wrapper for API call
+            # Use the enhanced retry wrapper for API call; the stream is consumed
+            # inside it so an interrupted stream is retried as a whole
             def api_call():
-                return self.openai_client.chat.completions.create(**params)
+                return self._stream_completion(params)
                 
-            response = self._api_call_with_enhanced_retries(api_call)
-            content = response.choices[0].message.content.strip()
+            content = self._api_call_with_enhanced_retries(api_call).strip()
             
             # Validate output length
             content_words = self.text_processor.count_words(content)
@@ -606,8 +793,28 @@ class TranscriptTransformer:
             # Provide a minimal fallback content to avoid complete failure
             return f"{time_marker} {section_type.capitalize()} (Error during generation)\n\nWe apologize, but there was an error generating this section."
         
-    def _calculate_max_tokens(self, section_type: str, target_words: int) -> int:
-        """Calculate appropriate max_tokens based on section and model"""
+    def _stream_completion(self, params: Dict) -> str:
+        """
+        Run a streaming chat completion and collect the generated text
+        
+        Streaming keeps the connection active on long sections instead of
+        waiting for the whole body, avoiding read timeouts on large outputs.
+        
+        Args:
+            params: Chat completion parameters (without stream)
+            
+        Returns:
+            str: Concatenated content of all streamed deltas
+        """
+        parts = []
+        stream = self.openai_client.chat.completions.create(stream=True, **params)
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+        return "".join(parts)
+        
+    def _calculate_max_tokens(self, section_type: str, target_words: int, prompt: str = "") -> int:
+        """Calculate appropriate max_tokens based on section, model and prompt size"""
         # 1 token ≈ 4 caracteres (1 palabra ≈ 1.33 tokens)
         base_tokens = int(target_words * 1.5)  # Margen para formato
         
@@ -622,7 +829,35 @@ class TranscriptTransformer:
             return min(base_tokens * 2, section_limits.get(section_type, 16000))
         
         # Límites para otros modelos
-        return min(base_tokens + 1000, self.MAX_TOKENS)
+        max_tokens = min(base_tokens + 1000, self.MAX_TOKENS)
+        
+        # Respect the model's completion cap so the request is not rejected
+        output_cap = self.MODEL_MAX_OUTPUT_TOKENS.get(self.model_name)
+        if output_cap and max_tokens > output_cap:
+            logger.warning(
+                f"Clamping max_tokens from {max_tokens} to {output_cap}, "
+                f"the completion limit of {self.model_name}"
+            )
+            max_tokens = output_cap
+        
+        # Keep prompt + completion inside the context window so the request is not rejected
+        context_window = self.MODEL_CONTEXT_WINDOWS.get(self.model_name)
+        if context_window and prompt:
+            prompt_tokens = len(_get_encoding(self.model_name).encode(prompt)) + self.MESSAGE_TOKEN_OVERHEAD
+            available_tokens = context_window - prompt_tokens
+            if available_tokens <= 0:
+                raise ValueError(
+                    f"Prompt ({prompt_tokens} tokens) leaves no room for output in the "
+                    f"{context_window}-token context window of {self.model_name}"
+                )
+            if available_tokens < max_tokens:
+                logger.warning(
+                    f"Clamping max_tokens from {max_tokens} to {available_tokens} "
+                    f"to fit the {context_window}-token context window"
+                )
+                max_tokens = available_tokens
+            
+        return max_tokens
         
     def _generate_main_content(self,
                              structure_data: Dict,
@@ -647,12 +882,12 @@ class TranscriptTransformer:
             
         logger.info(f"Topic word allocations: {topic_words}")
         
-        # Generate content for each topic
-        topic_contents = []
+        # Snapshot the context each topic would see if generated in order.
+        # Each topic deliberately sees the narrative preceding the main content
+        # (not the previous topic's tail) so the API calls can run in parallel.
+        topic_contexts = []
         
         for topic in structure_data['topics']:
-            topic_target = topic_words[topic['title']]
-            
             # Update context for topic
             context['current_topic'] = topic
             if topic['title'] in context['pending_topics']:
@@ -660,19 +895,30 @@ class TranscriptTransformer:
                 context['pending_topics'].remove(topic['title'])
             context['key_terms'].update(topic['key_concepts'])
             
-            # Generate topic content
-            topic_content = self._generate_section(
+            topic_contexts.append({
+                **context,
+                'covered_topics': list(context['covered_topics']),
+                'pending_topics': list(context['pending_topics']),
+                'key_terms': set(context['key_terms']),
+                'current_narrative': context['current_narrative'].copy()
+            })
+            
+        def generate_topic(topic: Dict, topic_context: Dict) -> str:
+            return self._generate_section(
                 f"main_topic_{topic['title']}",
                 structure_data,
                 original_text,
-                topic_target,
+                topic_words[topic['title']],
                 include_examples,
-                context=context,
+                context=topic_context,
                 initial_prompt=initial_prompt
             )
             
-            topic_contents.append(topic_content)
-            context['current_narrative'] = topic_content[-1000:]
+        # Generate content for each topic, preserving topic order in the output
+        max_concurrent = self.MODEL_MAX_CONCURRENT_TOPICS.get(self.model_name, self.MAX_CONCURRENT_TOPICS)
+        max_workers = max(1, min(max_concurrent, len(topic_contexts)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            topic_contents = list(executor.map(generate_topic, structure_data['topics'], topic_contexts))
             
         return "\n\n".join(topic_contents)
         
@@ -680,19 +926,22 @@ class TranscriptTransformer:
         """Validate content coherence against structure"""
         logger.info("Validating content coherence")
         
+        # Lowercase the full lecture once instead of on every membership test
+        lowered = content.lower()
+        
         # Check for learning objectives
         for objective in structure_data['learning_objectives']:
-            if not any(term.lower() in content.lower() for term in objective.split()):
+            if not any(term in lowered for term in objective.lower().split()):
                 logger.warning(f"Learning objective not well covered: {objective}")
                 
         # Check for key terms
         for term in structure_data['key_terms']:
-            if content.lower().count(term.lower()) < 2:
+            if lowered.count(term.lower()) < 2:
                 logger.warning(f"Key term underutilized: {term}")
                 
         # Check topic coverage
         for topic in structure_data['topics']:
-            if not any(concept.lower() in content.lower() for concept in topic['key_concepts']):
+            if not any(concept.lower() in lowered for concept in topic['key_concepts']):
                 logger.warning(f"Topic concepts not well covered: {topic['title']}")
                 
         logger.info("Coherence validation complete") 
\ No newline at end of file
@@ -1,9 +1,26 @@
 import re
+from collections import Counter
 from typing import List, Optional
 
 class TextProcessor:
     """Handles text preprocessing and cleaning"""
     
+    # Common English and Spanish function words ignored by keyword extraction
+    STOPWORDS = frozenset({
+        'about', 'after', 'again', 'also', 'because', 'been', 'before', 'being',
+        'between', 'both', 'could', 'does', 'doing', 'each', 'even', 'from',
+        'have', 'having', 'here', 'into', 'just', 'know', 'like', 'make', 'many',
+        'more', 'most', 'much', 'only', 'other', 'over', 'really', 'same', 'should',
+        'some', 'such', 'than', 'that', 'their', 'them', 'then', 'there', 'these',
+        'they', 'thing', 'things', 'this', 'those', 'through', 'very', 'want',
+        'well', 'were', 'what', 'when', 'where', 'which', 'while', 'will', 'with',
+        'would', 'your', 'yeah', 'going', 'okay', 'right', 'think', 'actually',
+        'para', 'como', 'pero', 'porque', 'esto', 'esta', 'este', 'estos', 'estas',
+        'entonces', 'cuando', 'donde', 'también', 'sobre', 'todo', 'todos',
+        'tiene', 'tienen', 'puede', 'pueden', 'hacer', 'bueno', 'vamos', 'desde',
+        'entre', 'hasta', 'unos', 'unas', 'using', 'used'
+    })
+    
     def __init__(self):
         """Initialize text processor"""
         self.sentence_endings = r'[.!?]'
@@ -57,6 +74,25 @@ class TextProcessor:
         words = re.findall(self.word_pattern, text)
         return len(words)
     
+    def extract_keywords(self, text: str, top_n: int = 10, min_length: int = 4) -> List[str]:
+        """
+        Extract the most frequent content words from text
+        
+        Args:
+            text: Input text
+            top_n: Maximum number of keywords to return
+            min_length: Minimum keyword length in characters
+            
+        Returns:
+            List[str]: Lowercased keywords, most frequent first
+        """
+        words = re.findall(self.word_pattern, text.lower())
+        counts = Counter(
+            word for word in words
+            if len(word) >= min_length and word.isalpha() and word not in self.STOPWORDS
+        )
+        return [word for word, _ in counts.most_common(top_n)]
+    
     def _fix_ocr_errors(self, text: str) -> str:
         """Fix common OCR errors"""
         replacements = {
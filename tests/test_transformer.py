@@ -0,0 +1,139 @@
+import json
+import unittest
+
+from src.utils.text_processor import TextProcessor
+
+try:
+    from src.core.transformer import TranscriptTransformer
+except ImportError:  # openai / tiktoken not installed
+    TranscriptTransformer = None
+
+
+OUTLINE = {
+    "title": "Lecture",
+    "learning_objectives": ["Understand gradients"],
+    "topics": [
+        {
+            "title": "T1",
+            "key_concepts": ["gradient"],
+            "subtopics": ["descent"],
+            "duration_minutes": 5,
+            "objective_links": [1]
+        }
+    ],
+    "practical_applications": ["Training a model"],
+    "key_terms": ["gradient"]
+}
+
+
+@unittest.skipIf(TranscriptTransformer is None, "transformer dependencies not installed")
+class TestExtractJson(unittest.TestCase):
+    """Tests for TranscriptTransformer._extract_json"""
+
+    def setUp(self):
+        self.transformer = TranscriptTransformer.__new__(TranscriptTransformer)
+
+    def test_outline_wrapped_in_prose(self):
+        content = f"Here is the outline:\n```json\n{json.dumps(OUTLINE)}\n```"
+        self.assertEqual(self.transformer._extract_json(content), OUTLINE)
+
+    def test_truncated_outline_returns_none(self):
+        # A truncated response must not yield the first nested topic object
+        content = json.dumps(OUTLINE)[:-30]
+        self.assertIsNone(self.transformer._extract_json(content))
+
+    def test_outline_after_unrelated_object(self):
+        content = f'Note: {{"status": "ok"}} then the outline {json.dumps(OUTLINE)}'
+        self.assertEqual(self.transformer._extract_json(content), OUTLINE)
+
+    def test_braces_inside_strings(self):
+        outline = dict(OUTLINE, title='Sets like {a, b} and "quotes" \\ escapes }')
+        self.assertEqual(self.transformer._extract_json(json.dumps(outline)), outline)
+
+    def test_deeply_nested_input_returns_none(self):
+        content = "{\"a\": " * 20000 + "1" + "}" * 20000
+        self.assertIsNone(self.transformer._extract_json(content))
+
+
+
+@unittest.skipIf(TranscriptTransformer is None, "transformer dependencies not installed")
+class TestCalculateMaxTokens(unittest.TestCase):
+    """Tests for TranscriptTransformer._calculate_max_tokens"""
+
+    def setUp(self):
+        self.transformer = TranscriptTransformer.__new__(TranscriptTransformer)
+        self.transformer.use_thinking_model = False
+        self.transformer.model_name = "gpt-3.5-turbo"
+
+    def test_clamped_to_model_output_cap(self):
+        self.assertEqual(self.transformer._calculate_max_tokens("main_topic_A", 6000), 4096)
+
+    def test_small_sections_unchanged(self):
+        self.assertEqual(self.transformer._calculate_max_tokens("introduction", 100), 1150)
+
+    def test_uncapped_model(self):
+        self.transformer.model_name = "gemini-2.0-flash-exp"
+        self.assertEqual(self.transformer._calculate_max_tokens("main_topic_A", 6000), 10000)
+
+
+
+class TestExtractKeywords(unittest.TestCase):
+    """Tests for TextProcessor.extract_keywords"""
+
+    def setUp(self):
+        self.processor = TextProcessor()
+
+    def test_ordered_by_frequency(self):
+        text = "gradient gradient gradient neural neural network"
+        self.assertEqual(self.processor.extract_keywords(text), ["gradient", "neural", "network"])
+
+    def test_filters_stopwords_and_short_words(self):
+        text = "This would really help the model model and that thing"
+        self.assertEqual(self.processor.extract_keywords(text), ["model", "help"])
+
+    def test_top_n_limit(self):
+        text = "alpha alpha alpha beta beta gamma"
+        self.assertEqual(self.processor.extract_keywords(text, top_n=2), ["alpha", "beta"])
+
+
+@unittest.skipIf(TranscriptTransformer is None, "transformer dependencies not installed")
+class TestLocalFallbackStructure(unittest.TestCase):
+    """Tests for TranscriptTransformer._local_fallback_structure"""
+
+    TEXT = (
+        "Neural networks learn weights. Gradient descent updates the weights of "
+        "neural networks using gradients. Backpropagation computes gradients and "
+        "gradient descent minimizes the loss of neural networks."
+    )
+
+    def setUp(self):
+        self.transformer = TranscriptTransformer.__new__(TranscriptTransformer)
+        self.transformer.text_processor = TextProcessor()
+
+    def test_short_text_uses_default_structure(self):
+        structure_data = self.transformer._local_fallback_structure("hello there", 30)
+        self.assertEqual(structure_data, self.transformer._default_structure(30))
+
+    def test_topics_from_keywords(self):
+        structure_data = self.transformer._local_fallback_structure(self.TEXT, 30)
+        keywords = self.transformer.text_processor.extract_keywords(self.TEXT, top_n=10)
+        self.assertEqual(structure_data['key_terms'], keywords)
+        self.assertEqual(
+            [topic['title'] for topic in structure_data['topics']],
+            [term.capitalize() for term in keywords[:3]]
+        )
+        self.assertTrue(all(topic['duration_minutes'] == 10 for topic in structure_data['topics']))
+
+    def test_structure_is_valid_outline(self):
+        structure_data = self.transformer._local_fallback_structure(self.TEXT, 30)
+        for key in TranscriptTransformer.REQUIRED_STRUCTURE_KEYS:
+            self.assertIn(key, structure_data)
+        self.transformer._prepare_structure(structure_data)
+        self.assertEqual(
+            structure_data['_topic_titles'],
+            [topic['title'] for topic in structure_data['topics']]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()